@@ -0,0 +1,240 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Per device latency of the download-handler routes, using local fakes.
+
+Runs initialize_download_for_device from functions/download-handler against
+in-process fakes of Cloud IoT, Cloud Storage, IAM and the token broker, where
+every remote call sleeps for --latency-ms. The token broker fake sleeps for
+three calls (its own hop, IAM generateAccessToken and STS). Reports the mean
+per device latency and the number of remote calls of each route. The token
+route is run twice: first when the per device buckets still have to be
+created, then when they already exist.
+
+    python benchmarks/download_routes.py --devices 200 --latency-ms 20
+'''
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import types
+
+_HANDLER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'download-handler')
+
+remote_calls = collections.Counter()
+latency = 0.0
+
+
+def _remote(name, weight=1):
+    remote_calls[name] += weight
+    time.sleep(latency * weight)
+
+
+class _NotFound(Exception):
+    pass
+
+
+class _Conflict(Exception):
+    pass
+
+
+class _FailedPrecondition(Exception):
+    pass
+
+
+class _HTTPError(Exception):
+    pass
+
+
+class _FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.md5_hash = 'XrY7u+Ae7tCTyyK7j1rNww=='
+        self.content_encoding = None
+
+    def generate_signed_url(self, **kwargs):
+        _remote('iam.signBlob')
+        return f'https://storage.googleapis.com/{self.bucket.name}/{self.name}?X-Goog-Signature=fake'
+
+
+class _FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.iam_configuration = types.SimpleNamespace()
+
+    def blob(self, name):
+        return _FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        _remote('storage.copy_blob')
+        return _FakeBlob(destination_bucket, new_name)
+
+
+class _FakeStorageClient:
+    def __init__(self):
+        self.buckets = set()
+
+    def bucket(self, name):
+        return _FakeBucket(name)
+
+    def get_bucket(self, name):
+        _remote('storage.get_bucket')
+        if name not in self.buckets:
+            raise _NotFound(name)
+        return _FakeBucket(name)
+
+    def create_bucket(self, bucket):
+        _remote('storage.create_bucket')
+        self.buckets.add(bucket.name)
+        return bucket
+
+
+class _FakeIotClient:
+    def device_path(self, *parts):
+        return '/'.join(parts)
+
+    def get_device(self, path, mask):
+        _remote('iot.get_device')
+        return types.SimpleNamespace(blocked=False, num_id=abs(hash(path)))
+
+    def send_command_to_device(self, path, message):
+        _remote('iot.send_command')
+
+
+class _FakeCredentials:
+    service_account_email = 'handler@example.iam.gserviceaccount.com'
+    token = 'token'
+
+    def refresh(self, request):
+        _remote('metadata.token')
+
+
+class _FakeResponse:
+    status_code = 200
+    headers = {}
+    content = json.dumps({'access_token': 'downscoped'}).encode('utf-8')
+
+    def raise_for_status(self):
+        pass
+
+
+def _fake_post(url, headers=None, json=None):
+    # Broker hop plus its IAM generateAccessToken and STS token exchange.
+    _remote('token-broker (+iam +sts)', weight=3)
+    return _FakeResponse()
+
+
+def _fake_fetch_id_token(request, audience):
+    _remote('metadata.id_token')
+    return 'id-token'
+
+
+def _install_fake_modules():
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    google = module('google')
+    auth = module('google.auth', default=lambda: (_FakeCredentials(), 'project'))
+    transport = module('google.auth.transport')
+    transport_requests = module('google.auth.transport.requests', Request=object)
+    oauth2 = module('google.oauth2')
+    id_token = module('google.oauth2.id_token', fetch_id_token=_fake_fetch_id_token)
+    cloud = module('google.cloud')
+    iot_v1 = module(
+        'google.cloud.iot_v1',
+        DeviceManagerClient=_FakeIotClient,
+        types=types.SimpleNamespace(FieldMask=lambda paths: paths))
+    storage = module('google.cloud.storage', Client=_FakeStorageClient)
+    exceptions = module('google.cloud.exceptions', NotFound=_NotFound, Conflict=_Conflict)
+    api_core = module('google.api_core')
+    api_core_exceptions = module(
+        'google.api_core.exceptions', FailedPrecondition=_FailedPrecondition)
+    module('requests', post=_fake_post, HTTPError=_HTTPError)
+
+    google.auth, google.oauth2, google.cloud, google.api_core = auth, oauth2, cloud, api_core
+    auth.transport, transport.requests = transport, transport_requests
+    oauth2.id_token = id_token
+    cloud.iot_v1, cloud.storage, cloud.exceptions = iot_v1, storage, exceptions
+    api_core.exceptions = api_core_exceptions
+
+
+class _FakeRequest:
+    def __init__(self, body):
+        self._body = body
+
+    def get_json(self):
+        return json.loads(json.dumps(self._body))
+
+
+def _request(device_index, download_mode):
+    return _FakeRequest({
+        'device': {
+            'PROJECT': 'project',
+            'LOCATION': 'us-central1',
+            'REGISTRY': 'registry',
+            'DEVICE_ID': f'device-{device_index}',
+        },
+        'file': {'bucket-name': 'shared-artifacts', 'blob-name': 'firmware.bin'},
+        'download-mode': download_mode,
+    })
+
+
+def run(handler, download_mode, devices):
+    remote_calls.clear()
+    start = time.perf_counter()
+    # The handler prints a line for every bucket that is not found yet.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for device_index in range(devices):
+            handler.initialize_download_for_device(_request(device_index, download_mode))
+    elapsed = time.perf_counter() - start
+    return elapsed / devices, dict(remote_calls)
+
+
+def main():
+    global latency
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+    latency = args.latency_ms / 1000
+
+    _install_fake_modules()
+    sys.path.insert(0, _HANDLER_DIR)
+    import main as handler
+
+    routes = (('token (new buckets)', 'token'),
+              ('token (existing buckets)', 'token'),
+              ('signed-url', 'signed-url'))
+    for label, download_mode in routes:
+        per_device, calls = run(handler, download_mode, args.devices)
+        calls_per_device = sum(calls.values()) / args.devices
+        print(f'{label:>24}: {per_device * 1000:7.1f} ms/device, '
+              f'{calls_per_device:.1f} remote calls/device')
+        for name, count in sorted(calls.items()):
+            print(f'{"":>26}{name}: {count}')
+
+
+if __name__ == '__main__':
+    main()
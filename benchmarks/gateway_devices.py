@@ -0,0 +1,201 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+CloudIotGateway with many bound devices, using an in-process fake MQTT client.
+
+paho's Client is replaced by a fake that accepts every connect, subscribe and
+publish without network I/O. CloudIotGateway, its JWT signing (ES256, needs
+pyjwt and cryptography from the client requirements) and command routing are
+the real code. Reports:
+
+  - memory per attached device (BoundDevice, routing entry and one handler),
+  - attach and re-attach (on_connect after a reconnect) time,
+  - time the MQTT network thread spends routing commands, and the time until
+    the worker pool has run every handler, with handlers that sleep.
+
+    python benchmarks/gateway_devices.py --devices 1000 --handler-ms 5
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+_CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client')
+
+
+class _FakeMqttClient:
+    def __init__(self, client_id=''):
+        self.on_connect = None
+        self.on_message = None
+        self.publishes = 0
+        self.subscribes = 0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, ca_certs=None):
+        pass
+
+    def connect(self, host, port):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def loop_start(self):
+        self.connack()
+
+    def connack(self):
+        # paho calls on_connect from its network thread once the CONNACK arrives.
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def publish(self, topic, payload, qos=0):
+        self.publishes += 1
+
+    def subscribe(self, topic, qos=0):
+        self.subscribes += 1
+
+    def unsubscribe(self, topic):
+        pass
+
+
+def _install_fake_paho():
+    paho = types.ModuleType('paho')
+    paho_mqtt = types.ModuleType('paho.mqtt')
+    paho_mqtt_client = types.ModuleType('paho.mqtt.client')
+    paho_mqtt_client.Client = _FakeMqttClient
+    paho_mqtt_client.connack_string = lambda rc: f'rc={rc}'
+    paho.mqtt, paho_mqtt.client = paho_mqtt, paho_mqtt_client
+    sys.modules.update({
+        'paho': paho, 'paho.mqtt': paho_mqtt, 'paho.mqtt.client': paho_mqtt_client})
+
+
+def _write_config(directory):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key_file = os.path.join(directory, 'ec_private.pem')
+    private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    with open(key_file, 'wb') as f:
+        f.write(private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()))
+
+    config_file = os.path.join(directory, 'cloud_config.ini')
+    with open(config_file, 'w') as f:
+        f.write('\n'.join([
+            '[DEFAULT]',
+            'Enabled = true',
+            'ProjectID = project',
+            'CloudRegion = us-central1',
+            'RegistryID = registry',
+            'DeviceID = gateway',
+            'CACerts = roots.pem',
+            'MQTTBridgeHostName = localhost',
+            'MQTTBridgePort = 8883',
+            'MessageType = event',
+            'Algorithm = ES256',
+            f'PrivateKeyFile = {key_file}',
+        ]))
+    return config_file
+
+
+class _SleepHandler:
+    __slots__ = ('handled',)
+
+    delay = 0.0
+    done = None
+    remaining = 0
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.handled = 0
+
+    def on_message(self, json_payload):
+        time.sleep(_SleepHandler.delay)
+        self.handled += 1
+        with _SleepHandler.lock:
+            _SleepHandler.remaining -= 1
+            if _SleepHandler.remaining == 0:
+                _SleepHandler.done.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--commands-per-device', type=int, default=2)
+    parser.add_argument('--handler-ms', type=float, default=5.0)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    _install_fake_paho()
+    sys.path.insert(0, _CLIENT_DIR)
+    from core import CloudIotGateway
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = _write_config(directory)
+        with CloudIotGateway(config_file, max_workers=args.workers) as gateway:
+            client = gateway._client
+
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            for device_index in range(args.devices):
+                gateway.attach_device(f'device-{device_index}', [_SleepHandler()])
+            attach_time = time.perf_counter() - start
+            per_device = (tracemalloc.get_traced_memory()[0] - before) / args.devices
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            client.connack()
+            reattach_time = time.perf_counter() - start
+
+            commands = args.devices * args.commands_per_device
+            _SleepHandler.delay = args.handler_ms / 1000
+            _SleepHandler.done = threading.Event()
+            _SleepHandler.remaining = commands
+            payload = json.dumps({'message-type': 'NOOP'}).encode('utf-8')
+            messages = [
+                types.SimpleNamespace(topic=f'/devices/device-{i % args.devices}/commands',
+                                      payload=payload)
+                for i in range(commands)]
+
+            start = time.perf_counter()
+            for message in messages:
+                client.on_message(client, None, message)
+            routing_time = time.perf_counter() - start
+            _SleepHandler.done.wait()
+            total_time = time.perf_counter() - start
+
+    print(f'devices: {args.devices}, workers: {args.workers}, '
+          f'handler: {args.handler_ms} ms, commands: {commands}')
+    print(f'memory per attached device: {per_device:.0f} bytes')
+    print(f'attach: {attach_time * 1000:.1f} ms, re-attach on connect: {reattach_time * 1000:.1f} ms')
+    print(f'network thread routing: {routing_time / commands * 1e6:.1f} us/command')
+    print(f'all handlers done after {total_time:.2f} s '
+          f'({commands * args.handler_ms / 1000 / args.workers:.2f} s ideal)')
+
+
+if __name__ == '__main__':
+    main()
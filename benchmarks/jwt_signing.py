@@ -0,0 +1,76 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+JWT signing time per algorithm, as done by CloudIot._create_jwt.
+
+For RS256 (RSA 2048) and ES256 (P-256) keys, times PyJWT encode with the PEM
+string, which re-parses the key on every call, and with the key object loaded
+once, which is what CloudIot does. Needs the client requirements (pyjwt and
+cryptography) and generates throwaway keys, so it runs on the device itself.
+
+    python benchmarks/jwt_signing.py --iterations 200
+'''
+
+import argparse
+import datetime
+import time
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+
+def _generate_keys():
+    backend = default_backend()
+    return {
+        'RS256': rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=backend),
+        'ES256': ec.generate_private_key(ec.SECP256R1(), backend),
+    }
+
+
+def _to_pem(private_key):
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+
+def _time_encode(jwt_inst, key, algorithm, iterations):
+    now = datetime.datetime.utcnow()
+    token = {'iat': now, 'exp': now + datetime.timedelta(minutes=60), 'aud': 'project'}
+    start = time.perf_counter()
+    for _ in range(iterations):
+        jwt_inst.encode(token, key, algorithm=algorithm)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    jwt_inst = jwt.PyJWT()
+    for algorithm, private_key in _generate_keys().items():
+        pem = _to_pem(private_key)
+        pem_time = _time_encode(jwt_inst, pem, algorithm, args.iterations)
+        key_time = _time_encode(jwt_inst, private_key, algorithm, args.iterations)
+        print(f'{algorithm}: {pem_time * 1000:7.3f} ms/JWT from PEM, '
+              f'{key_time * 1000:7.3f} ms/JWT from loaded key')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,11 @@
 import logging
 import google.oauth2.credentials
 import os
+import requests
 import threading
 
 from datetime import datetime, timedelta
+from download_pipeline import DownloadPipeline
 from google.cloud import storage
 
 logging.basicConfig(level=20)
@@ -57,9 +59,14 @@ class GCSDownloadHandler:
     """
     Manages blob download from Google Cloud Storage.
 
-    Takes bucket name, blob name, project id and access token as input.
+    Takes bucket name, blob name, project id and access token as input, or
+    a signed URL for the blob. Downloads go through a :class:`DownloadPipeline`,
+    so the file only appears at its final path once it is complete and verified.
     """
 
+    # (connect, read) timeouts in seconds for signed URL downloads.
+    _SIGNED_URL_TIMEOUT = (10, 60)
+
     def __init__(self, project_id, local_file_path=None):
         self._project_id = project_id
 
@@ -78,6 +85,10 @@ class GCSDownloadHandler:
             message = json_payload['message']
             download_fail_msg = 'Failed to download file.'
 
+            if 'signed-url' in message:
+                self._download_from_signed_url(message)
+                return
+
             storage_client = GCSClientHelper.get_storage_client(self._project_id, message['access-token'])
             if not storage_client:
                 logger.warn(download_fail_msg)
@@ -96,11 +107,69 @@ class GCSDownloadHandler:
                 return
 
             try:
-                blob.download_to_filename(f'{self._local_file_path}/{blob_name}')
+                # Raw download keeps gzip Content-Encoding objects compressed, so the
+                # MD5 matches the stored bytes and the pipeline does the decompression.
+                pipeline = self._create_pipeline(
+                    message, message.get('md5-hash'), blob.content_encoding)
+                with pipeline:
+                    blob.download_to_file(pipeline, raw_download=True)
+                    pipeline.commit()
             except Exception as e:
-                logger.warn(f'Fail to download file: {blob}. {e}')
+                logger.warn(f'Fail to download file: {blob_name}. {e}')
+                return
 
-            logger.info(f'Successfully downloaded {self._local_file_path}/{blob_name}')
+            logger.info(f'Successfully downloaded {self._target_path(message)}')
+
+    def _download_from_signed_url(self, message):
+        blob_name = message['file']
+        try:
+            with requests.get(
+                    message['signed-url'], stream=True, timeout=self._SIGNED_URL_TIMEOUT) as response:
+                response.raise_for_status()
+                expected_md5 = message.get('md5-hash') or self._md5_from_headers(response.headers)
+                pipeline = self._create_pipeline(
+                    message, expected_md5, response.headers.get('Content-Encoding'))
+                with pipeline:
+                    # Read the raw body so the bytes hashed are the stored bytes,
+                    # even when the object has a gzip Content-Encoding.
+                    pipeline.write_from(response.raw.stream(
+                        DownloadPipeline._CHUNK_SIZE, decode_content=False))
+                    pipeline.commit()
+        except Exception as e:
+            logger.warn(f'Fail to download file: {blob_name}. {e}')
+            return
+
+        logger.info(f'Successfully downloaded {self._target_path(message)}')
+
+    def _create_pipeline(self, message, expected_md5, content_encoding=None):
+        return DownloadPipeline(
+            self._target_path(message),
+            expected_md5=expected_md5,
+            compression=self._compression(message, content_encoding))
+
+    def _compression(self, message, content_encoding=None):
+        """
+        Compression of the stored blob: the message's 'compression' field (set by
+        download-handler from the blob's Content-Encoding), else the Content-Encoding
+        of the blob or response. Anything else, e.g. a plain .tar.gz, is stored as is.
+        """
+        if 'compression' in message:
+            return message['compression']
+        if content_encoding == 'gzip':
+            return 'gzip'
+        return None
+
+    def _target_path(self, message):
+        return f'{self._local_file_path}/{message["file"]}'
+
+    @staticmethod
+    def _md5_from_headers(headers):
+        # x-goog-hash: crc32c=n03x6A==,md5=Ojk9c3dhfxgoKVVHYwFbHQ==
+        for value in headers.get('x-goog-hash', '').split(','):
+            name, _, digest = value.strip().partition('=')
+            if name == 'md5':
+                return digest
+        return None
 
 
 class GCSUploadHandler:
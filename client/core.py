@@ -16,6 +16,8 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
 import configparser
 import datetime
 import json
@@ -26,11 +28,18 @@ import paho.mqtt.client as mqtt
 import threading
 import time
 
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_CONFIG_LOCATION = os.path.join(os.path.dirname(__file__), 'cloud_config.ini')
 
+# Cloud IoT Core rejects JWTs that are valid for more than 24 hours.
+MAX_JWT_LIFETIME_MINUTES = 24 * 60
+
 class CloudIot:
     """
     Manages a connection to Google Cloud IoT Core via MQTT, using a JWT for device
@@ -70,12 +79,28 @@ class CloudIot:
         self._mqtt_bridge_port = config.getint('MQTTBridgePort')
 
         self._mutex = threading.Lock()
-
-        # For SW, use RS256 on a key file provided in the configuration.
-        self._algorithm = 'RS256'
-        rsa_cert = config['RSACertFile']
-        with open(rsa_cert, 'r') as f:
-            self._private_key = f.read()
+        self._user_on_connect = None
+
+        # For SW, use RS256 or ES256 on a key file provided in the configuration.
+        self._algorithm = config.get('Algorithm', 'RS256')
+        if self._algorithm not in ('RS256', 'ES256'):
+            raise ValueError('Unsupported JWT algorithm: %s' % self._algorithm)
+        jwt_lifetime_minutes = config.getint('JWTLifetimeMinutes', 60)
+        if not 0 < jwt_lifetime_minutes <= MAX_JWT_LIFETIME_MINUTES:
+            raise ValueError('JWTLifetimeMinutes must be between 1 and %d' % MAX_JWT_LIFETIME_MINUTES)
+        self._jwt_lifetime = datetime.timedelta(minutes=jwt_lifetime_minutes)
+        jwt_refresh_margin_minutes = config.getint('JWTRefreshMarginMinutes', 10)
+        if not 0 <= jwt_refresh_margin_minutes < jwt_lifetime_minutes:
+            raise ValueError(
+                'JWTRefreshMarginMinutes must be between 0 and JWTLifetimeMinutes - 1')
+        self._jwt_refresh_margin = datetime.timedelta(minutes=jwt_refresh_margin_minutes)
+
+        # Parse the key once, PyJWT would otherwise re-parse the PEM on every encode.
+        private_key_file = config.get('PrivateKeyFile', config.get('RSACertFile'))
+        with open(private_key_file, 'rb') as f:
+            self._private_key = serialization.load_pem_private_key(
+                f.read(), password=None, backend=default_backend())
+        self._check_private_key(private_key_file)
         self._jwt_inst = jwt.PyJWT()
 
         # Create our MQTT client. The client_id is a unique string that identifies
@@ -101,6 +126,9 @@ class CloudIot:
         # Enable SSL/TLS support.
         self._client.tls_set(ca_certs=self._ca_certs)
 
+        # Subscriptions are (re)made on every connect, including paho's own reconnects.
+        self._install_callbacks()
+
         # Connect to the Google MQTT bridge.
         self._client.connect(self._mqtt_bridge_hostname,
                              self._mqtt_bridge_port)
@@ -108,11 +136,6 @@ class CloudIot:
         logger.info('Successfully connected to Cloud IoT')
         self._enabled = True
         self._client.loop_start()
-        # The topic that the device will receive commands on.
-        mqtt_command_topic = '/devices/{}/commands/#'.format(self._device_id)
-
-        # Subscribe to the commands topic, QoS 1 enables message acknowledgement.
-        self._client.subscribe(mqtt_command_topic, qos=1)
 
     def __enter__(self):
         return self
@@ -143,6 +166,9 @@ class CloudIot:
             message (obj): The message to send. It can be any message that's serializable into a
                 JSON message using :func:`json.dumps` (such as a dictionary or string).
         """
+        self._publish(self._device_id, message)
+
+    def _publish(self, device_id, message):
         if not self._enabled:
             return
 
@@ -151,7 +177,7 @@ class CloudIot:
             # Publish to the events or state topic based on the flag.
             sub_topic = 'events' if self._message_type == 'event' else 'state'
 
-            mqtt_topic = '/devices/%s/%s' % (self._device_id, sub_topic)
+            mqtt_topic = '/devices/%s/%s' % (device_id, sub_topic)
 
             # Publish payload using JSON dumps to create bytes representation.
             payload = json.dumps(message)
@@ -170,7 +196,8 @@ class CloudIot:
                 <https://pypi.org/project/paho-mqtt/#callbacks>`_ to your own function names.
         """
         if 'on_connect' in callbacks:
-            self._client.on_connect = callbacks['on_connect']
+            # Called after the command subscriptions are renewed.
+            self._user_on_connect = callbacks['on_connect']
         if 'on_disconnect' in callbacks:
             self._client.on_disconnect = callbacks['on_disconnect']
         if 'on_publish' in callbacks:
@@ -183,14 +210,17 @@ class CloudIot:
             self._client.on_log = callbacks['on_log']
 
     def _token_update_loop(self, term_event):
-        # Update token every 50 minutes (of allowed 60).
-        while not term_event.wait(50 * 60):
+        # Update token the configured margin before it expires.
+        refresh_interval = (self._jwt_lifetime - self._jwt_refresh_margin).total_seconds()
+        while not term_event.wait(refresh_interval):
+            # Sign the new token before taking the connection down.
+            token = self._create_jwt()
             with self._mutex:
                 self._client.disconnect()
 
                 # Set new token.
                 self._client.username_pw_set(
-                    username='unused', password=self._create_jwt())
+                    username='unused', password=token)
 
                 # Connect to the Google MQTT bridge.
                 self._client.connect(
@@ -199,6 +229,36 @@ class CloudIot:
                 logger.info(
                     'Successfully re-established connection with new token')
 
+    def _install_callbacks(self):
+        self._client.on_connect = self._on_connect
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            # A clean session drops subscriptions, so renew them on every connect.
+            self._subscribe()
+        else:
+            logger.warn('Connection to Cloud IoT refused: %s' % mqtt.connack_string(rc))
+
+        if self._user_on_connect:
+            self._user_on_connect(client, userdata, flags, rc)
+
+    def _subscribe(self):
+        # The topic that the device will receive commands on.
+        mqtt_command_topic = '/devices/{}/commands/#'.format(self._device_id)
+
+        # Subscribe to the commands topic, QoS 1 enables message acknowledgement.
+        self._client.subscribe(mqtt_command_topic, qos=1)
+
+    def _check_private_key(self, private_key_file):
+        """Fails at load time if the key cannot sign with the configured algorithm."""
+        if self._algorithm == 'RS256':
+            valid = isinstance(self._private_key, rsa.RSAPrivateKey)
+        else:
+            valid = (isinstance(self._private_key, ec.EllipticCurvePrivateKey)
+                     and isinstance(self._private_key.curve, ec.SECP256R1))
+        if not valid:
+            raise ValueError('%s is not a valid %s private key' % (private_key_file, self._algorithm))
+
     def _create_jwt(self):
         """Creates a JWT (https://jwt.io) to establish an MQTT connection.
             Args:
@@ -206,17 +266,206 @@ class CloudIot:
                  algorithm: The encryption algorithm to use. Either 'RS256' or 'ES256'
             Returns:
                 An MQTT generated from the given project_id and private key, which
-                expires in 20 minutes. After 20 minutes, your client will be
+                expires after JWTLifetimeMinutes. After that, your client will be
                 disconnected, and a new JWT will have to be generated.
         """
 
+        now = datetime.datetime.utcnow()
         token = {
             # The time that the token was issued at
-            'iat': datetime.datetime.utcnow(),
+            'iat': now,
             # The time the token expires.
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60),
+            'exp': now + self._jwt_lifetime,
             # The audience field should always be set to the GCP project id.
             'aud': self._project_id
         }
 
         return self._jwt_inst.encode(token, self._private_key, algorithm=self._algorithm)
+
+
+class BoundDevice:
+    """
+    A device attached to a :class:`CloudIotGateway`.
+
+    Offers the :meth:`publish_message` and :meth:`project_id` subset of :class:`CloudIot`, so
+    handlers such as ``GCSUploadHandler`` can be created per bound device.
+    """
+
+    __slots__ = ('_gateway', '_device_id', '_handlers', '_pending')
+
+    def __init__(self, gateway, device_id, handlers=()):
+        self._gateway = gateway
+        self._device_id = device_id
+        self._handlers = tuple(handlers)
+        # None while idle, else the commands waiting behind the one being handled.
+        self._pending = None
+
+    def device_id(self):
+        return self._device_id
+
+    def project_id(self):
+        return self._gateway.project_id()
+
+    def publish_message(self, message):
+        """
+        Sends an arbitrary message to the Cloud Iot Core service on behalf of this device.
+
+        Args:
+            message (obj): The message to send, serializable with :func:`json.dumps`.
+        """
+        self._gateway._publish(self._device_id, message)
+
+    def register_handlers(self, handlers):
+        """
+        Args:
+            handlers (iterable): Objects with an ``on_message(json_payload)`` method that
+                receive the commands sent to this device.
+        """
+        self._handlers = tuple(handlers)
+
+    def on_message(self, json_payload):
+        for handler in self._handlers:
+            try:
+                handler.on_message(json_payload)
+            except Exception:
+                logger.warn(f'{type(handler).__name__} failed to handle message for {self._device_id}')
+
+    def _dispatch(self, json_payload):
+        # Runs on the MQTT network thread: hand the command to the gateway's worker
+        # pool, keeping the commands of one device in order.
+        with self._gateway._dispatch_lock:
+            if self._pending is not None:
+                self._pending.append(json_payload)
+                return
+            self._pending = collections.deque()
+        self._gateway._executor.submit(self._drain, json_payload)
+
+    def _drain(self, json_payload):
+        while True:
+            self.on_message(json_payload)
+            with self._gateway._dispatch_lock:
+                if not self._pending:
+                    self._pending = None
+                    return
+                json_payload = self._pending.popleft()
+
+
+class CloudIotGateway(CloudIot):
+    """
+    Manages one Cloud IoT Core gateway connection that serves many bound devices.
+
+    The gateway connects with its own JWT (the DeviceID in the configuration must be a
+    gateway), so all bound devices share one MQTT connection and one token refresh thread.
+    Devices are attached with :meth:`attach_device`, and commands sent to each device are
+    routed to the handlers of its :class:`BoundDevice`. Handlers run on a shared worker pool,
+    so a slow handler does not block the MQTT network thread or the other devices.
+    """
+
+    _ATTACH_PAYLOAD = json.dumps({'authorization': ''})
+
+    def __init__(self, config_file=DEFAULT_CONFIG_LOCATION, config_section='DEFAULT',
+                 max_workers=4):
+        """
+        Args:
+            config_file (str): Path to your Cloud IoT configuration file (.ini).
+            config_section (str): The section name in the .ini file where the Cloud IoT Core config
+                can be read. By default, it reads from the "[DEFAULT]" section.
+            max_workers (int): Number of threads that run the handlers of the bound devices.
+        """
+        self._bound_devices = {}
+        self._gateway_on_message = None
+        self._dispatch_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='gateway-handler')
+        super().__init__(config_file, config_section)
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        super().__exit__(exception_type, exception_value, traceback)
+        self._executor.shutdown(wait=True)
+
+    def attach_device(self, device_id, handlers=()):
+        """
+        Attaches a device bound to this gateway and subscribes to its commands.
+
+        Args:
+            device_id (str): ID of a device bound to the gateway in the registry.
+            handlers (iterable): Objects with an ``on_message(json_payload)`` method.
+
+        Returns:
+            The :class:`BoundDevice` for ``device_id``.
+        """
+        device = BoundDevice(self, device_id, handlers)
+        if not self._enabled:
+            return device
+
+        with self._mutex:
+            self._bound_devices[device_id] = device
+            self._attach(device_id)
+        return device
+
+    def detach_device(self, device_id):
+        """
+        Detaches a bound device, its commands are no longer received.
+
+        Args:
+            device_id (str): ID of a previously attached device.
+        """
+        if not self._enabled:
+            return
+
+        with self._mutex:
+            if self._bound_devices.pop(device_id, None) is None:
+                return
+            self._client.unsubscribe('/devices/{}/commands/#'.format(device_id))
+            self._client.publish('/devices/{}/detach'.format(device_id), '{}', qos=1)
+
+    def bound_devices(self):
+        return list(self._bound_devices.values())
+
+    def register_message_callbacks(self, callbacks):
+        """
+        Same as :meth:`CloudIot.register_message_callbacks`, except that ``on_message`` only
+        receives the commands that are not sent to an attached device.
+        """
+        callbacks = dict(callbacks)
+        self._gateway_on_message = callbacks.pop('on_message', None)
+        super().register_message_callbacks(callbacks)
+
+    def _install_callbacks(self):
+        super()._install_callbacks()
+        self._client.on_message = self._on_message
+
+    def _subscribe(self):
+        super()._subscribe()
+        # Gateway errors, such as rejected attach requests.
+        self._client.subscribe('/devices/{}/errors'.format(self._device_id), qos=0)
+        # Copy under the GIL, attach_device may add devices from another thread.
+        for device_id in list(self._bound_devices):
+            self._attach(device_id)
+
+    def _attach(self, device_id):
+        self._client.publish(
+            '/devices/{}/attach'.format(device_id), self._ATTACH_PAYLOAD, qos=1)
+        self._client.subscribe('/devices/{}/commands/#'.format(device_id), qos=1)
+
+    def _on_message(self, client, userdata, message):
+        # Topic format: /devices/<device_id>/<commands|errors>[/...]
+        topic_parts = message.topic.split('/')
+        device_id = topic_parts[2] if len(topic_parts) > 3 else None
+
+        if device_id == self._device_id and topic_parts[3] == 'errors':
+            logger.warn(f'Gateway error: {message.payload.decode("utf-8")}')
+            return
+
+        device = self._bound_devices.get(device_id)
+        if device is None:
+            if self._gateway_on_message:
+                self._gateway_on_message(client, userdata, message)
+            return
+
+        try:
+            json_payload = json.loads(message.payload.decode('utf-8'))
+        except ValueError:
+            logger.warn(f'Invalid command payload for {device_id}')
+            return
+        device._dispatch(json_payload)
@@ -0,0 +1,171 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming hash check, decompression and atomic store of downloaded files
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+class DownloadPipeline:
+    """
+    Writable file-like object that verifies, decompresses and stores a download in one pass.
+
+    Every chunk handed to :meth:`write` is fed to the MD5 hash, the optional gzip/zstd
+    decompressor and a temporary file next to the destination, so the bytes are only
+    traversed once. :meth:`commit` checks the hash and atomically renames the temporary
+    file onto the destination path; on any failure the temporary file is removed and
+    nothing is left at the destination.
+    """
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, file_path, expected_md5=None, compression=None):
+        """
+        Args:
+            file_path (str): Final path of the downloaded (and decompressed) file.
+            expected_md5 (str): Base64 encoded MD5 of the transferred bytes, as reported by
+                Cloud Storage. The hash check is skipped if not provided.
+            compression (str): 'gzip', 'zstd' or None.
+        """
+        self._file_path = file_path
+        self._expected_md5 = expected_md5
+        self._md5 = hashlib.md5()
+        self._compression = compression
+        self._decompressor = self._create_decompressor(compression)
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._stage_time = {'hash': 0.0, 'decompress': 0.0, 'write': 0.0, 'rename': 0.0}
+        self._start = time.perf_counter()
+
+        directory, file_name = os.path.split(file_path)
+        fd, self._tmp_path = tempfile.mkstemp(
+            prefix=f'.{file_name}.', suffix='.part', dir=directory or None)
+        self._file = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None:
+            self.abort()
+
+    @staticmethod
+    def _create_decompressor(compression):
+        if not compression:
+            return None
+        if compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if compression == 'zstd':
+            # Optional dependency, only needed for zstd compressed blobs.
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError(f'Unsupported compression: {compression}')
+
+    def write(self, data):
+        t0 = time.perf_counter()
+        self._md5.update(data)
+        t1 = time.perf_counter()
+        output = self._decompress(data) if self._decompressor else data
+        t2 = time.perf_counter()
+        self._file.write(output)
+        t3 = time.perf_counter()
+
+        self._stage_time['hash'] += t1 - t0
+        self._stage_time['decompress'] += t2 - t1
+        self._stage_time['write'] += t3 - t2
+        self._bytes_in += len(data)
+        self._bytes_out += len(output)
+        return len(data)
+
+    def _decompress(self, data):
+        output = b''
+        # A multi-member gzip (e.g. from pigz or concatenated archives) or multi-frame
+        # zstd body is decompressed with a new decompressor for every member.
+        while data:
+            if self._decompressor.eof:
+                self._decompressor = self._create_decompressor(self._compression)
+            output += self._decompressor.decompress(data)
+            data = getattr(self._decompressor, 'unused_data', b'')
+        return output
+
+    def write_from(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self.write(chunk)
+
+    def commit(self):
+        if self._decompressor and hasattr(self._decompressor, 'flush'):
+            t0 = time.perf_counter()
+            tail = self._decompressor.flush()
+            t1 = time.perf_counter()
+            self._file.write(tail)
+            self._stage_time['decompress'] += t1 - t0
+            self._stage_time['write'] += time.perf_counter() - t1
+            self._bytes_out += len(tail)
+
+        if self._decompressor and not self._decompressor.eof:
+            self.abort()
+            raise ValueError(f'Truncated {self._compression} stream for {self._file_path}')
+
+        if self._expected_md5:
+            actual_md5 = base64.b64encode(self._md5.digest()).decode('utf-8')
+            if actual_md5 != self._expected_md5:
+                self.abort()
+                raise ValueError(
+                    f'MD5 mismatch for {self._file_path}: expected {self._expected_md5}, got {actual_md5}')
+
+        t0 = time.perf_counter()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, self._file_path)
+        self._stage_time['rename'] += time.perf_counter() - t0
+
+        self._log_stats()
+
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def _log_stats(self):
+        total_time = time.perf_counter() - self._start
+        stage_bytes = {
+            'hash': self._bytes_in,
+            'decompress': self._bytes_in,
+            'write': self._bytes_out,
+            'rename': self._bytes_out,
+        }
+        rates = ', '.join(
+            f'{stage} {self._rate(stage_bytes[stage], seconds)}'
+            for stage, seconds in self._stage_time.items()
+            if stage != 'decompress' or self._decompressor)
+        logger.info(
+            f'{self._file_path}: {self._bytes_in} bytes in, {self._bytes_out} bytes out, '
+            f'total {self._rate(self._bytes_in, total_time)} ({rates})')
+
+    @staticmethod
+    def _rate(num_bytes, seconds):
+        if seconds <= 0:
+            return 'n/a'
+        return f'{num_bytes / seconds / (1024 * 1024):.1f} MiB/s'
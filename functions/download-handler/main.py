@@ -12,19 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import os
 import requests
 import json
 from google import auth
 from google.cloud import iot_v1
 from google.cloud import storage
-from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import Conflict, NotFound
 from google.api_core.exceptions import FailedPrecondition
 import google.auth.transport.requests
 import google.oauth2.id_token
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
 iot_client = iot_v1.DeviceManagerClient()
 storage_client = storage.Client()
+broker_breaker = CircuitBreaker('token-broker')
+bucket_create_breaker = CircuitBreaker('bucket-create')
 
 
 '''
@@ -39,10 +44,25 @@ request json data format:
     "file": {
         "bucket-name": "...",
         "blob-name": "..."
-    }
+    },
+    "download-mode": "token" | "signed-url"    (optional)
 }
+
+The FILE-DOWNLOAD message sent to the device holds "file" and either
+"bucket" and "access-token", or "signed-url". It can also hold "md5-hash"
+(base64 MD5 of the stored bytes) and "compression" ("gzip" when the blob has
+a gzip Content-Encoding).
+
+download-mode "token" (default) copies the blob into a per device bucket and
+sends a downscoped access token for that bucket. "signed-url" skips the copy
+and the token broker, and sends a short lived V4 signed URL for the source
+blob instead. The default can be changed with the DOWNLOAD_MODE environment
+variable.
 '''
 
+DOWNLOAD_MODE_TOKEN = 'token'
+DOWNLOAD_MODE_SIGNED_URL = 'signed-url'
+
 
 def initialize_download_for_device(request):
     request_json = request.get_json()
@@ -52,8 +72,40 @@ def initialize_download_for_device(request):
         return 'Device blocked'
     device_info['num_id'] = device_detail.num_id
     download_file = request_json['file']
+    download_mode = request_json.get(
+        'download-mode', os.environ.get('DOWNLOAD_MODE', DOWNLOAD_MODE_TOKEN))
+    if download_mode not in (DOWNLOAD_MODE_TOKEN, DOWNLOAD_MODE_SIGNED_URL):
+        return f'Unknown download-mode: {download_mode}', 400
+    try:
+        if download_mode == DOWNLOAD_MODE_SIGNED_URL:
+            device_download_message = create_signed_url_message(download_file)
+        else:
+            device_download_message = create_access_token_message(
+                device_info, download_file)
+    except CircuitOpenError as e:
+        return e.http_reply(f'Download unavailable: {e}')
+    except requests.HTTPError as e:
+        # Pass the token broker's status (e.g. 503 with Retry-After) through.
+        return broker_error_response(e)
+    try:
+        response = send_download_message_to_device(device_info,
+        json.dumps(device_download_message).encode('utf-8'))
+    except FailedPrecondition:
+        return 'Device is not connected'
+    return 'Download message send'
+
+
+def broker_error_response(error):
+    headers = {}
+    if 'Retry-After' in error.response.headers:
+        headers['Retry-After'] = error.response.headers['Retry-After']
+    return (f'Token broker error: {error}', error.response.status_code, headers)
+
+
+def create_access_token_message(device_info, download_file):
     file_blob = add_file_to_device_bucket(device_info, download_file)
-    access_token = generate_access_token(file_blob)
+    access_token = broker_breaker.call(
+        file_blob.bucket.name, generate_access_token, file_blob)
     device_download_message = {
         'message-type': 'FILE-DOWNLOAD',
         'message': {
@@ -62,12 +114,26 @@ def initialize_download_for_device(request):
             'access-token': f'{access_token["access_token"]}'
         }
     }
-    try:
-        response = send_download_message_to_device(device_info,
-        json.dumps(device_download_message).encode('utf-8'))
-    except FailedPrecondition:
-        return 'Device is not connected'
-    return 'Download message send'
+    # Composite objects have no MD5, the device then skips the hash check.
+    if file_blob.md5_hash:
+        device_download_message['message']['md5-hash'] = file_blob.md5_hash
+    # Objects stored with Content-Encoding gzip (e.g. gsutil cp -z) are
+    # downloaded compressed and decompressed on the device.
+    if file_blob.content_encoding == 'gzip':
+        device_download_message['message']['compression'] = 'gzip'
+    return device_download_message
+
+
+def create_signed_url_message(download_file):
+    signed_url = generate_signed_url(
+        download_file['bucket-name'], download_file['blob-name'])
+    return {
+        'message-type': 'FILE-DOWNLOAD',
+        'message': {
+            'file': f'{download_file["blob-name"]}',
+            'signed-url': f'{signed_url}'
+        }
+    }
 
 
 def send_download_message_to_device(device_info, message_str):
@@ -101,7 +167,10 @@ def check_create_device_download_bucket(device_info):
     bucket_name = f"{device_info['num_id']}-download"
     bucket = get_bucket(bucket_name)
     if bucket is None:
-        bucket = create_bucket(device_info, bucket_name)
+        # Failed creates are negatively cached, a create racing with another
+        # function instance resolves through the Conflict handling below.
+        bucket = bucket_create_breaker.call(
+            bucket_name, create_bucket, device_info, bucket_name)
     return bucket
 
 
@@ -119,7 +188,11 @@ def create_bucket(device_info, bucket_name):
     bucket.location = device_info['LOCATION']
     bucket.storage_class = 'STANDARD'
     bucket.iam_configuration.uniform_bucket_level_access_enabled = True
-    return storage_client.create_bucket(bucket)
+    try:
+        return storage_client.create_bucket(bucket)
+    except Conflict:
+        # Another function instance created the bucket in the meantime.
+        return storage_client.get_bucket(bucket_name)
 
 
 def copy_blob(source_bucket_name, blob_name, destination_bucket):
@@ -128,6 +201,23 @@ def copy_blob(source_bucket_name, blob_name, destination_bucket):
     return source_bucket.copy_blob(source_blob, destination_bucket, blob_name)
 
 
+def generate_signed_url(bucket_name, blob_name):
+    # The function runs with token based credentials that hold no private key,
+    # so the URL is signed through the IAM signBlob API as the function's own
+    # service account.
+    credentials, project = auth.default()
+    auth_req = google.auth.transport.requests.Request()
+    credentials.refresh(auth_req)
+    blob = storage_client.bucket(bucket_name).blob(blob_name)
+    return blob.generate_signed_url(
+        version='v4',
+        expiration=datetime.timedelta(
+            seconds=int(os.environ.get('SIGNED_URL_LIFETIME', '900'))),
+        method='GET',
+        service_account_email=credentials.service_account_email,
+        access_token=credentials.token)
+
+
 def generate_access_token(file_blob):
     token_broker_url = os.environ.get(
         'TOKEN_BROKER_URL', 'Specified environment variable is not set.')
@@ -142,4 +232,5 @@ def generate_access_token(file_blob):
     function_headers = {'Authorization': f'bearer {id_token}'}
     function_response = requests.post(
         token_broker_url, headers=function_headers, json=param)
+    function_response.raise_for_status()
     return json.loads(function_response.content)
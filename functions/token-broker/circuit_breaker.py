@@ -0,0 +1,225 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Circuit breaker with short lived negative caching for remote calls.
+
+Each Cloud Function deploys its own copy of this module. The copies must stay
+identical, scripts/check-circuit-breaker-copies.sh and the tests verify that.
+
+Failures are remembered per key (e.g. a bucket name) for NEGATIVE_CACHE_TTL
+seconds, during which calls for that key are rejected without reaching the
+remote service. Only transient failures (5xx, 429, connection errors and
+timeouts) count towards opening the breaker: after FAILURE_THRESHOLD
+consecutive transient failures it rejects all calls for RESET_TIMEOUT seconds,
+then lets a single trial call through. Permanent failures, such as a 4xx for
+one device, are only negatively cached for their key, and the CircuitOpenError
+raised for that key carries the original status, so callers can answer with
+it instead of a retryable 503.
+
+The breaker state is kept per function instance. Breaker state changes and
+rejections are written as structured log entries, so logs-based metrics can be
+defined on the 'circuit-breaker' field.
+'''
+
+import json
+import math
+import os
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', '30'))
+NEGATIVE_CACHE_TTL = float(os.environ.get('CIRCUIT_NEGATIVE_CACHE_TTL', '10'))
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of calling the remote service. permanent is True when the
+    key was rejected because of an earlier permanent failure, status_code is
+    then that failure's HTTP status, if it had one.
+    '''
+
+    def __init__(self, breaker_name, key, retry_after, permanent=False, status_code=None):
+        super().__init__(
+            f'{breaker_name} unavailable for {key}, retry after {retry_after:.0f}s')
+        self.retry_after = retry_after
+        self.permanent = permanent
+        self.status_code = status_code
+
+    def http_reply(self, body):
+        '''
+        Cloud Function response for this rejection: the original 4xx for a
+        permanently failed key, else 503 with Retry-After.
+        '''
+        if self.permanent:
+            return body, self.status_code or 400
+        return body, 503, {'Retry-After': f'{max(1, math.ceil(self.retry_after))}'}
+
+
+def status_code_of(error):
+    '''
+    HTTP status of requests.HTTPError and google.api_core exceptions, else None.
+    '''
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        status = getattr(error, 'code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_transient_error(error):
+    '''
+    True for errors worth retrying later: HTTP 5xx and 429 (requests.HTTPError
+    and google.api_core exceptions), connection errors and timeouts.
+    '''
+    status = status_code_of(error)
+    if status is not None:
+        return status >= 500 or status == 429
+    # requests' ConnectionError and Timeout are OSErrors as well.
+    return isinstance(error, OSError)
+
+
+class CircuitBreaker:
+    def __init__(self, name,
+                 failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT,
+                 negative_cache_ttl=NEGATIVE_CACHE_TTL,
+                 is_transient=is_transient_error):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._negative_cache_ttl = negative_cache_ttl
+        self._is_transient = is_transient
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_progress = False
+        self._consecutive_failures = 0
+        self._negative_cache = {}
+        self._calls = 0
+        self._transient_failures = 0
+        self._permanent_failures = 0
+        self._rejections = 0
+
+    def call(self, key, func, *args, **kwargs):
+        '''
+        Calls func(*args, **kwargs) unless the breaker or the negative cache
+        for key rejects it, in which case CircuitOpenError is raised.
+        '''
+        with self._lock:
+            state_before = self._state
+            rejection = self._check_allowed(key)
+            state_after = self._state
+        if state_after != state_before:
+            self._log_state()
+        if rejection is not None:
+            _log('WARNING', self.metrics(), f'rejected call for {key}')
+            raise rejection
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record(key, e)
+            raise
+        self._record(key, None)
+        return result
+
+    def metrics(self):
+        with self._lock:
+            self._prune_negative_cache(time.monotonic())
+            return {
+                'name': self.name,
+                'state': self._state,
+                'calls': self._calls,
+                'transient-failures': self._transient_failures,
+                'permanent-failures': self._permanent_failures,
+                'rejections': self._rejections,
+                'negative-cache-size': len(self._negative_cache),
+            }
+
+    def _check_allowed(self, key):
+        '''Returns the CircuitOpenError to raise, or None if the call may go ahead.'''
+        now = time.monotonic()
+        self._prune_negative_cache(now)
+        retry_at, permanent, status_code = self._negative_cache.get(key, (None, False, None))
+
+        if retry_at is None and self._state == OPEN:
+            if now - self._opened_at >= self._reset_timeout:
+                self._state = HALF_OPEN
+            else:
+                retry_at = self._opened_at + self._reset_timeout
+
+        if retry_at is None and self._state == HALF_OPEN:
+            if self._trial_in_progress:
+                # Only a single trial call is let through while half-open.
+                retry_at = now + self._reset_timeout
+            else:
+                self._trial_in_progress = True
+
+        if retry_at is not None:
+            self._rejections += 1
+            return CircuitOpenError(self.name, key, retry_at - now, permanent, status_code)
+        self._calls += 1
+        return None
+
+    def _record(self, key, error):
+        with self._lock:
+            state_before = self._state
+            now = time.monotonic()
+            self._trial_in_progress = False
+            if error is None:
+                self._consecutive_failures = 0
+                self._state = CLOSED
+            elif self._is_transient(error):
+                self._transient_failures += 1
+                self._consecutive_failures += 1
+                self._negative_cache[key] = (now + self._negative_cache_ttl, False, None)
+                if (self._state == HALF_OPEN
+                        or self._consecutive_failures >= self._failure_threshold):
+                    self._opened_at = now
+                    self._state = OPEN
+            else:
+                # The service answered, the request itself is bad: only this key
+                # is rejected for a while, the breaker state is left alone.
+                self._permanent_failures += 1
+                self._negative_cache[key] = (
+                    now + self._negative_cache_ttl, True, status_code_of(error))
+                if self._state == HALF_OPEN:
+                    self._state = CLOSED
+            state_after = self._state
+        if state_after != state_before:
+            self._log_state()
+
+    def _prune_negative_cache(self, now):
+        expired = [key for key, (until, _, _) in self._negative_cache.items() if until <= now]
+        for key in expired:
+            del self._negative_cache[key]
+
+    def _log_state(self):
+        metrics = self.metrics()
+        _log('WARNING' if metrics['state'] == OPEN else 'INFO',
+             metrics, f'{self.name} circuit {metrics["state"]}')
+
+
+def _log(severity, metrics, message):
+    print(json.dumps({
+        'severity': severity,
+        'message': message,
+        'circuit-breaker': metrics,
+    }))
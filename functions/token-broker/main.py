@@ -8,18 +8,42 @@ from google import auth
 import json
 import six
 from six.moves import http_client
+from circuit_breaker import CircuitBreaker, CircuitOpenError
 
 _STS_ENDPOINT = "https://sts.googleapis.com/v1beta/token"
 _IAM_SA_ENDPOINT = "https://iamcredentials.googleapis.com/v1/projects/-/serviceAccounts/"
 
+iam_breaker = CircuitBreaker('iam')
+sts_breaker = CircuitBreaker('sts')
+
 def generate_down_scoped_token(request):
     request_json = request.get_json()
     access_type = request_json['access-type']
     access_bucket = request_json['access-bucket']
 
-    short_lived_token = generate_short_lived_token(access_type)
-    return down_scope_access_token(access_type, access_bucket, short_lived_token)
+    # Both calls are keyed per request: the IAM call only depends on the
+    # access type, but keying it by that would let one failure reject every
+    # device's request for the negative cache TTL.
+    request_key = f'{access_type.lower()}/{access_bucket}'
+    try:
+        short_lived_token = iam_breaker.call(
+            request_key, generate_short_lived_token, access_type)
+        return sts_breaker.call(
+            request_key, down_scope_access_token,
+            access_type, access_bucket, short_lived_token)
+    except CircuitOpenError as e:
+        return e.http_reply({'error': str(e)})
+    except requests.HTTPError as e:
+        # Pass the IAM or STS status through, so callers can tell a bad
+        # request (4xx) from an outage (5xx).
+        return upstream_error_response(e)
+
 
+def upstream_error_response(error):
+    headers = {}
+    if 'Retry-After' in error.response.headers:
+        headers['Retry-After'] = error.response.headers['Retry-After']
+    return {'error': str(error)}, error.response.status_code, headers
 
 
 def generate_short_lived_token(access_type):
@@ -31,7 +55,9 @@ def generate_short_lived_token(access_type):
         data={
             "lifetime": f"{os.environ.get('TOKEN_LIFETIME', 'Specified environment variable is not set.')}s",
             "scope" : ["https://www.googleapis.com/auth/cloud-platform"]})
-                
+    # HTTPError carries the status, so the circuit breaker can tell 5xx from 4xx.
+    response.raise_for_status()
+
     return json.loads(response.content.decode("utf-8"))["accessToken"]
 
 def down_scope_access_token(access_type, access_bucket, short_lived_token):
@@ -47,6 +73,7 @@ def down_scope_access_token(access_type, access_bucket, short_lived_token):
     }
 
     resp = authed_session.post(_STS_ENDPOINT, data=body)
+    resp.raise_for_status()
     if resp.status_code != http_client.OK:
         raise exceptions.RefreshError("Failed to acquire downscoped token")
 
@@ -8,19 +8,28 @@ import requests
 from google import auth
 from google.cloud import iot_v1
 from google.cloud import storage
-from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import Conflict, NotFound
 from google.api_core.exceptions import FailedPrecondition
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
 iot_client = iot_v1.DeviceManagerClient()
 storage_client = storage.Client()
+broker_breaker = CircuitBreaker('token-broker')
+bucket_create_breaker = CircuitBreaker('bucket-create')
 
 def on_iot_event(event, context):
     message_str = base64.b64decode(event['data']).decode('utf-8')
     message_obj = json.loads(message_str)
     if message_obj['message-type'] == 'UPLOAD-REQUEST':
         device_info = get_device_info(event)
-        bucket = check_create_device_upload_bucket(device_info)
-        access_token = generate_access_token(bucket.name)
+        try:
+            bucket = check_create_device_upload_bucket(device_info)
+            access_token = broker_breaker.call(
+                bucket.name, generate_access_token, bucket.name)
+        except (CircuitOpenError, requests.HTTPError) as e:
+            print(f'Upload temporarily unavailable: {e}')
+            return 'Upload temporarily unavailable'
         device_upload_message = {
             'message-type': 'FILE-UPLOAD',
             'message': {
@@ -48,7 +57,10 @@ def check_create_device_upload_bucket(device_info):
     bucket_name = f"{device_info['NUM_ID']}-upload"
     bucket = get_bucket(bucket_name)
     if bucket is None:
-        bucket = create_bucket(device_info, bucket_name)
+        # Failed creates are negatively cached, a create racing with another
+        # function instance resolves through the Conflict handling below.
+        bucket = bucket_create_breaker.call(
+            bucket_name, create_bucket, device_info, bucket_name)
     return bucket
 
 def get_bucket(bucket_name):
@@ -64,7 +76,11 @@ def create_bucket(device_info, bucket_name):
     bucket.location = device_info['LOCATION']
     bucket.storage_class = 'STANDARD'
     bucket.iam_configuration.uniform_bucket_level_access_enabled = True
-    return storage_client.create_bucket(bucket)
+    try:
+        return storage_client.create_bucket(bucket)
+    except Conflict:
+        # Another function instance created the bucket in the meantime.
+        return storage_client.get_bucket(bucket_name)
 
 def generate_access_token(bucket_name):
     token_broker_url = os.environ.get(
@@ -80,6 +96,7 @@ def generate_access_token(bucket_name):
     function_headers = {'Authorization': f'bearer {id_token}'}
     function_response = requests.post(
         token_broker_url, headers=function_headers, json=param)
+    function_response.raise_for_status()
     return json.loads(function_response.content)
 
 def send_message_to_device(device_info, message_str):
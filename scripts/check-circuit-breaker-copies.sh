@@ -0,0 +1,40 @@
+#!/usr/bin/env sh
+
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Each Cloud Function is deployed from its own directory, so circuit_breaker.py
+# is copied into every function. Fail if the copies have drifted apart.
+
+if ! command -v sha256sum >/dev/null 2>&1; then
+    echo "sha256sum command is not available, but it's needed. Terminating..."
+    exit 1
+fi
+
+FUNCTIONS_DIR="$(dirname "$0")/../functions"
+REFERENCE=${FUNCTIONS_DIR}/token-broker/circuit_breaker.py
+REFERENCE_SUM=$(sha256sum < "${REFERENCE}")
+
+STATUS=0
+for COPY in "${FUNCTIONS_DIR}"/download-handler/circuit_breaker.py "${FUNCTIONS_DIR}"/upload-handler/circuit_breaker.py; do
+    if [ "$(sha256sum < "${COPY}")" != "${REFERENCE_SUM}" ]; then
+        echo "${COPY} differs from ${REFERENCE}"
+        STATUS=1
+    fi
+done
+
+if [ ${STATUS} -eq 0 ]; then
+    echo "All circuit_breaker.py copies are identical."
+fi
+exit ${STATUS}
@@ -82,7 +82,7 @@ resource "google_cloudiot_device" "test-device" {
 
   credentials {
     public_key {
-        format = "RSA_PEM"
+        format = var.google_iot_device_key_format
         key = file(var.google_iot_device_key_path)
     }
   }
@@ -136,6 +136,14 @@ resource "google_service_account_iam_binding" "create-write-token-permission" {
   ]
 }
 
+resource "google_service_account_iam_binding" "sign-url-permission" {
+  service_account_id = "projects/-/serviceAccounts/${google_service_account.iot-gcs-access-handler-sa.email}"
+  role               = "roles/iam.serviceAccountTokenCreator"
+  members = [
+      "serviceAccount:${google_service_account.iot-gcs-access-handler-sa.email}",
+  ]
+}
+
 resource "google_project_iam_member" "storage-admin-permission" {
   project = var.google_project_id
   role    = "roles/storage.admin"
@@ -229,6 +237,8 @@ resource "google_cloudfunctions_function" "download-handler-cf" {
 
   environment_variables = {
     TOKEN_BROKER_URL = google_cloudfunctions_function.token-broker-cf.https_trigger_url
+    DOWNLOAD_MODE = "token"
+    SIGNED_URL_LIFETIME = "900"
   }
 
   depends_on = [
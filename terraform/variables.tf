@@ -2,4 +2,7 @@ variable "google_project_id" {}
 variable "google_default_region" {}
 variable "google_iot_registry_id" {}
 variable "google_iot_device_id" {}
-variable "google_iot_device_key_path" {}
\ No newline at end of file
+variable "google_iot_device_key_path" {}
+variable "google_iot_device_key_format" {
+  default = "RSA_PEM"
+}
\ No newline at end of file
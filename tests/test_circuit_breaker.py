@@ -0,0 +1,200 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import os
+import types
+
+import pytest
+
+_FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+_COPIES = [
+    os.path.join(_FUNCTIONS_DIR, function, 'circuit_breaker.py')
+    for function in ('token-broker', 'download-handler', 'upload-handler')]
+
+
+def _load(path):
+    spec = importlib.util.spec_from_file_location('circuit_breaker', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+circuit_breaker = _load(_COPIES[0])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'HTTP {status_code}')
+        self.response = types.SimpleNamespace(status_code=status_code)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return circuit_breaker.CircuitBreaker(
+        'test', failure_threshold=2, reset_timeout=30, negative_cache_ttl=10)
+
+
+def fail(status_code):
+    def call():
+        raise HttpError(status_code)
+    return call
+
+
+def succeed():
+    return 'ok'
+
+
+def test_copies_are_identical():
+    contents = set()
+    for path in _COPIES:
+        with open(path, 'rb') as f:
+            contents.add(f.read())
+    assert len(contents) == 1
+
+
+@pytest.mark.parametrize('error, transient', [
+    (HttpError(503), True),
+    (HttpError(500), True),
+    (HttpError(429), True),
+    (HttpError(400), False),
+    (HttpError(404), False),
+    (types.SimpleNamespace(code=503), True),
+    (types.SimpleNamespace(code=409), False),
+    (ConnectionError(), True),
+    (TimeoutError(), True),
+    (KeyError('num_id'), False),
+])
+def test_is_transient_error(error, transient):
+    assert circuit_breaker.is_transient_error(error) is transient
+
+
+def test_opens_after_consecutive_transient_failures(breaker):
+    for key in ('a', 'b'):
+        with pytest.raises(HttpError):
+            breaker.call(key, fail(503))
+
+    assert breaker.metrics()['state'] == circuit_breaker.OPEN
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.call('c', succeed)
+    assert breaker.metrics()['rejections'] == 1
+
+
+def test_success_resets_failure_count(breaker):
+    with pytest.raises(HttpError):
+        breaker.call('a', fail(503))
+    assert breaker.call('b', succeed) == 'ok'
+    with pytest.raises(HttpError):
+        breaker.call('c', fail(503))
+
+    assert breaker.metrics()['state'] == circuit_breaker.CLOSED
+
+
+def test_permanent_failures_do_not_open(breaker):
+    for key in ('a', 'b', 'c', 'd'):
+        with pytest.raises(HttpError):
+            breaker.call(key, fail(400))
+
+    metrics = breaker.metrics()
+    assert metrics['state'] == circuit_breaker.CLOSED
+    assert metrics['permanent-failures'] == 4
+    assert breaker.call('e', succeed) == 'ok'
+
+
+def test_half_open_lets_single_trial_through(breaker, clock):
+    for key in ('a', 'b'):
+        with pytest.raises(HttpError):
+            breaker.call(key, fail(503))
+    clock.now += 30
+
+    def trial():
+        # A second call while the trial is running is rejected.
+        assert breaker.metrics()['state'] == circuit_breaker.HALF_OPEN
+        with pytest.raises(circuit_breaker.CircuitOpenError):
+            breaker.call('d', succeed)
+        return 'ok'
+
+    assert breaker.call('c', trial) == 'ok'
+    assert breaker.metrics()['state'] == circuit_breaker.CLOSED
+
+
+def test_failed_trial_reopens(breaker, clock):
+    for key in ('a', 'b'):
+        with pytest.raises(HttpError):
+            breaker.call(key, fail(503))
+    clock.now += 30
+
+    with pytest.raises(HttpError):
+        breaker.call('c', fail(503))
+
+    assert breaker.metrics()['state'] == circuit_breaker.OPEN
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.call('d', succeed)
+
+
+def test_negative_cache_rejects_key_until_ttl(breaker, clock):
+    with pytest.raises(HttpError):
+        breaker.call('a', fail(404))
+
+    with pytest.raises(circuit_breaker.CircuitOpenError) as rejected:
+        breaker.call('a', succeed)
+    assert rejected.value.retry_after == 10
+    assert breaker.call('b', succeed) == 'ok'
+
+    clock.now += 10
+    assert breaker.call('a', succeed) == 'ok'
+
+
+def test_expired_negative_cache_entries_are_pruned(breaker, clock):
+    with pytest.raises(HttpError):
+        breaker.call('a', fail(404))
+    assert breaker.metrics()['negative-cache-size'] == 1
+
+    clock.now += 10
+    assert breaker.metrics()['negative-cache-size'] == 0
+
+
+def test_permanently_failed_key_keeps_status(breaker):
+    with pytest.raises(HttpError):
+        breaker.call('a', fail(403))
+
+    with pytest.raises(circuit_breaker.CircuitOpenError) as rejected:
+        breaker.call('a', succeed)
+    assert rejected.value.permanent
+    assert rejected.value.http_reply('denied') == ('denied', 403)
+
+
+def test_transiently_failed_key_replies_503(breaker):
+    with pytest.raises(HttpError):
+        breaker.call('a', fail(503))
+
+    with pytest.raises(circuit_breaker.CircuitOpenError) as rejected:
+        breaker.call('a', succeed)
+    assert not rejected.value.permanent
+    assert rejected.value.http_reply('down') == ('down', 503, {'Retry-After': '10'})
@@ -0,0 +1,103 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import gzip
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+from download_pipeline import DownloadPipeline
+
+DATA = bytes(range(256)) * 43
+
+
+def md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('utf-8')
+
+
+def chunks(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def download(path, body, expected_md5=None, compression=None, chunk_size=1000):
+    with DownloadPipeline(str(path), expected_md5=expected_md5, compression=compression) as pipeline:
+        pipeline.write_from(chunks(body, chunk_size))
+        pipeline.commit()
+
+
+def test_plain_download(tmp_path):
+    download(tmp_path / 'file', DATA, expected_md5=md5(DATA))
+
+    assert (tmp_path / 'file').read_bytes() == DATA
+    assert os.listdir(tmp_path) == ['file']
+
+
+def test_md5_mismatch_leaves_nothing(tmp_path):
+    with pytest.raises(ValueError, match='MD5 mismatch'):
+        download(tmp_path / 'file', DATA, expected_md5=md5(b'other'))
+
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, 100000])
+def test_multi_member_gzip(tmp_path, chunk_size):
+    body = gzip.compress(DATA) + gzip.compress(DATA)
+
+    download(tmp_path / 'file', body, expected_md5=md5(body), compression='gzip',
+             chunk_size=chunk_size)
+
+    assert (tmp_path / 'file').read_bytes() == DATA * 2
+
+
+def test_multi_frame_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    compressor = zstandard.ZstdCompressor()
+    body = compressor.compress(DATA) + compressor.compress(DATA)
+
+    download(tmp_path / 'file', body, expected_md5=md5(body), compression='zstd')
+
+    assert (tmp_path / 'file').read_bytes() == DATA * 2
+
+
+def test_truncated_gzip_is_not_committed(tmp_path):
+    body = gzip.compress(DATA)[:-100]
+
+    with pytest.raises(ValueError, match='Truncated gzip'):
+        download(tmp_path / 'file', body, compression='gzip')
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_truncated_zstd_is_not_committed(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    body = zstandard.ZstdCompressor().compress(DATA)[:-10]
+
+    with pytest.raises(ValueError, match='Truncated zstd'):
+        download(tmp_path / 'file', body, compression='zstd')
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_write_error_leaves_nothing(tmp_path):
+    with pytest.raises(RuntimeError):
+        with DownloadPipeline(str(tmp_path / 'file')) as pipeline:
+            pipeline.write(DATA)
+            raise RuntimeError('connection reset')
+
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,172 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Error paths of functions/token-broker, with the Google auth libraries and the
+IAM and STS endpoints replaced by in-process fakes.
+'''
+
+import http.client
+import importlib.util
+import json
+import os
+import sys
+import types
+
+import pytest
+
+_BROKER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'token-broker')
+
+
+class HTTPError(IOError):
+    def __init__(self, *args, response=None):
+        super().__init__(*args)
+        self.response = response
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(body or {}).encode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError(f'{self.status_code} Error', response=self)
+
+
+class FakeEndpoints:
+    def __init__(self):
+        self.iam = FakeResponse(200, {'accessToken': 'short-lived'})
+        self.sts = FakeResponse(200, {'access_token': 'downscoped'})
+        self.iam_calls = 0
+
+    def post(self, url, data=None):
+        if ':generateAccessToken' in url:
+            self.iam_calls += 1
+            return self.iam
+        return self.sts
+
+
+@pytest.fixture
+def endpoints():
+    return FakeEndpoints()
+
+
+@pytest.fixture
+def broker(monkeypatch, endpoints):
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        monkeypatch.setitem(sys.modules, name, mod)
+        return mod
+
+    google = module('google')
+    auth = module('google.auth', default=lambda: (object(), 'project'))
+    transport = module('google.auth.transport')
+    transport_requests = module(
+        'google.auth.transport.requests',
+        Request=object,
+        AuthorizedSession=lambda credentials=None: endpoints)
+    credentials = module('google.auth.credentials', AnonymousCredentials=object)
+    exceptions = module('google.auth.exceptions', RefreshError=type('RefreshError', (Exception,), {}))
+    google.auth = auth
+    auth.transport, auth.credentials, auth.exceptions = transport, credentials, exceptions
+    transport.requests = transport_requests
+    six = module('six')
+    six.moves = module('six.moves', http_client=http.client)
+    module('requests', HTTPError=HTTPError)
+
+    monkeypatch.syspath_prepend(_BROKER_DIR)
+    monkeypatch.delitem(sys.modules, 'circuit_breaker', raising=False)
+    spec = importlib.util.spec_from_file_location(
+        'token_broker_main', os.path.join(_BROKER_DIR, 'main.py'))
+    broker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(broker)
+    return broker
+
+
+def token_request(bucket, access_type='read'):
+    return types.SimpleNamespace(
+        get_json=lambda: {'access-type': access_type, 'access-bucket': bucket})
+
+
+def call_broker(broker, bucket):
+    '''What download-handler sees: the broker's reply as an HTTP response.'''
+    reply = broker.generate_down_scoped_token(token_request(bucket))
+    if not isinstance(reply, tuple):
+        return reply
+    body, status = reply[0], reply[1]
+    headers = reply[2] if len(reply) > 2 else {}
+    FakeResponse(status, body, headers).raise_for_status()
+    return body
+
+
+def test_success(broker):
+    assert call_broker(broker, 'bucket') == {'access_token': 'downscoped'}
+
+
+def test_iam_403_is_passed_through_and_caller_breaker_stays_closed(broker, endpoints):
+    endpoints.iam = FakeResponse(403, {'error': 'permission denied'})
+    caller_breaker = broker.CircuitBreaker('token-broker', failure_threshold=5)
+
+    for device in range(10):
+        with pytest.raises(HTTPError) as error:
+            caller_breaker.call(f'{device}-download', call_broker, broker, f'{device}-download')
+        assert error.value.response.status_code == 403
+
+    assert caller_breaker.metrics()['state'] == 'closed'
+    assert broker.iam_breaker.metrics()['state'] == 'closed'
+
+
+def test_permanently_failed_key_is_rejected_with_original_status(broker, endpoints):
+    endpoints.iam = FakeResponse(403)
+    broker.generate_down_scoped_token(token_request('bucket'))
+
+    body, status = broker.generate_down_scoped_token(token_request('bucket'))
+
+    assert status == 403
+    assert endpoints.iam_calls == 1
+
+
+def test_transiently_failed_key_is_rejected_with_503(broker, endpoints):
+    endpoints.iam = FakeResponse(500)
+    broker.generate_down_scoped_token(token_request('bucket'))
+
+    body, status, headers = broker.generate_down_scoped_token(token_request('bucket'))
+
+    assert status == 503
+    assert 'Retry-After' in headers
+
+
+def test_iam_failure_only_rejects_its_own_request(broker, endpoints):
+    endpoints.iam = FakeResponse(503)
+    broker.generate_down_scoped_token(token_request('first-bucket'))
+    endpoints.iam = FakeResponse(200, {'accessToken': 'short-lived'})
+
+    assert call_broker(broker, 'second-bucket') == {'access_token': 'downscoped'}
+    assert endpoints.iam_calls == 2
+
+
+def test_sts_503_status_and_retry_after_are_passed_through(broker, endpoints):
+    endpoints.sts = FakeResponse(503, headers={'Retry-After': '7'})
+
+    body, status, headers = broker.generate_down_scoped_token(token_request('bucket'))
+
+    assert status == 503
+    assert headers == {'Retry-After': '7'}